@@ -1,26 +1,85 @@
+from collections import namedtuple
 from datetime import datetime
+
 import dash_ag_grid as dag
 import dash_mantine_components as dmc
-import pandas as pd
+import numpy as np
 import plotly.express as px
-from dash import Dash, Input, Output, callback, dcc, html
+import plotly.graph_objects as go
+from dash import (
+    Dash,
+    Input,
+    Output,
+    Patch,
+    State,
+    callback,
+    clientside_callback,
+    dcc,
+    html,
+    no_update,
+)
+from flask_caching import Cache
+from store import (
+    CATEGORY_COLUMNS,
+    CLUSTER_MAX_ZOOM,
+    DATE_COLUMNS,
+    EventStore,
+    tokenize,
+)
 
 app = Dash(__name__)
 server = app.server
-df = pd.read_csv("evenements.csv")
-
-
-def generate_map(df):
-    scatter_map = px.scatter_map(
-        df,
-        lat="lat",
-        lon="long",
-        color="type_evenement",
-        color_discrete_sequence=px.colors.qualitative.Prism,
-        zoom=10,
-        hover_data=["titre"],
+# Shared by the gunicorn workers, so a filter combination is computed once
+cache = Cache(
+    server,
+    config={
+        "CACHE_TYPE": "FileSystemCache",
+        "CACHE_DIR": "cache-directory",
+        "CACHE_THRESHOLD": 500,
+        "CACHE_DEFAULT_TIMEOUT": 600,
+    },
+)
+store = EventStore("evenements.csv")
+grid_columns = [
+    "id",
+    "titre",
+    "date_debut",
+    "date_fin",
+    "type_evenement",
+    "arrondissement",
+]
+
+
+def generate_map(snapshot):
+    """Empty styled map: one trace per event type, then the cluster trace."""
+    colors = px.colors.qualitative.Prism
+    scatter_map = go.Figure(
+        [
+            go.Scattermap(
+                lat=[],
+                lon=[],
+                mode="markers",
+                name=event_type,
+                marker=dict(color=colors[i % len(colors)]),
+                hovertemplate="%{text}<extra></extra>",
+            )
+            for i, event_type in enumerate(snapshot.df["type_evenement"].cat.categories)
+        ]
+        + [
+            go.Scattermap(
+                lat=[],
+                lon=[],
+                mode="markers+text",
+                marker=dict(color=colors[0], sizemode="area", sizeref=0.5, sizemin=12),
+                textfont=dict(color="white"),
+                hovertemplate="%{text} événements<extra></extra>",
+                showlegend=False,
+            )
+        ]
     )
     scatter_map.update_layout(
+        map=dict(center=dict(lat=45.53, lon=-73.65), zoom=10),
+        uirevision="map",
         margin={"l": 0, "r": 0, "t": 0, "b": 50},
         legend=dict(
             orientation="h",
@@ -34,14 +93,37 @@ def generate_map(df):
     return scatter_map
 
 
+def map_traces(snapshot, mask, zoom):
+    """Data of each generate_map trace: clusters below CLUSTER_MAX_ZOOM, else points."""
+    df = snapshot.df
+    n_types = len(df["type_evenement"].cat.categories)
+    empty = dict(lat=[], lon=[], text=[])
+    if zoom < CLUSTER_MAX_ZOOM:
+        lat, lon, counts = store.clusters(mask, zoom, snapshot=snapshot)
+        return [empty] * n_types + [dict(lat=lat, lon=lon, text=counts)], counts
+    rows = np.flatnonzero(mask)
+    codes = df["type_evenement"].cat.codes.to_numpy()[rows]
+    traces = []
+    for i in range(n_types):
+        events = df.iloc[rows[codes == i]]
+        traces.append(
+            dict(
+                lat=events["lat"].to_numpy(),
+                lon=events["long"].to_numpy(),
+                text=events["titre"].to_numpy(),
+            )
+        )
+    return traces + [empty], []
+
+
 def generate_dropdown(col, label, value=[]):
-    data = pd.read_csv("evenements.csv")
     return dmc.MultiSelect(
-        data=[{"label": i, "value": i} for i in data[col].dropna().unique()],
+        data=store.vocabularies[col],
         label=label,
         placeholder="Choisir...",
         value=value,
         id=col,
+        debounce=300,
     )
 
 
@@ -60,6 +142,13 @@ app.layout = dmc.MantineProvider(
                                 """
                             ),
                             dmc.Divider(),
+                            dmc.TextInput(
+                                id="search",
+                                label="Recherche",
+                                placeholder="Mots-clés...",
+                                value="",
+                                debounce=300,
+                            ),
                             generate_dropdown("type_evenement", "Événement(s)"),
                             generate_dropdown("emplacement", "Emplacement(s)"),
                             generate_dropdown("arrondissement", "Arrondissement(s)"),
@@ -73,6 +162,19 @@ app.layout = dmc.MantineProvider(
                                 label="Date de Fin",
                                 placeholder="Choisir...",
                             ),
+                            dmc.Switch(
+                                id="map-filter",
+                                label="Limiter à la vue de la carte",
+                                checked=False,
+                            ),
+                            dmc.NumberInput(
+                                id="radius",
+                                label="Rayon autour du point cliqué (km)",
+                                placeholder="Cliquez sur la carte...",
+                                min=0,
+                                step=0.5,
+                                debounce=300,
+                            ),
                         ],
                         className="card sidebar",
                     ),
@@ -99,7 +201,18 @@ app.layout = dmc.MantineProvider(
                             html.Div(
                                 [
                                     html.Div(
-                                        [dcc.Graph(id="map")],
+                                        [
+                                            dcc.Graph(
+                                                id="map",
+                                                figure=generate_map(store.current()),
+                                            ),
+                                            dcc.Store(id="map-zoom", data=10),
+                                            dcc.Store(id="map-bounds"),
+                                            dcc.Store(id="map-point"),
+                                            dcc.Store(
+                                                id="map-version", data=store.mtime
+                                            ),
+                                        ],
                                         className="card medium-card",
                                     ),
                                     html.Div(
@@ -139,10 +252,12 @@ app.layout = dmc.MantineProvider(
                                                         "width": 200,
                                                     },
                                                 ],
-                                                rowData=[],
+                                                rowModelType="infinite",
+                                                getRowId="params.data.id",
                                                 dashGridOptions={
                                                     "pagination": True,
                                                     "paginationPageSize": 30,
+                                                    "cacheBlockSize": 30,
                                                     "rowSelection": "single",
                                                 },
                                                 defaultColDef={
@@ -170,33 +285,111 @@ app.layout = dmc.MantineProvider(
 )
 
 
-@callback(
-    Output("grid", "rowData"),
-    Output("map", "figure"),
-    Output("search-results", "children"),
+filter_inputs = [
     Input("type_evenement", "value"),
     Input("emplacement", "value"),
     Input("arrondissement", "value"),
     Input("date_debut", "value"),
     Input("date_fin", "value"),
+    Input("search", "value"),
+]
+# The map shows every filtered event, only the other outputs follow the map view
+spatial_inputs = [
+    Input("map-filter", "checked"),
+    Input("map-bounds", "data"),
+    Input("radius", "value"),
+    Input("map-point", "data"),
+]
+
+
+Filters = namedtuple(
+    "Filters",
+    [
+        "version",
+        "type_evenement",
+        "emplacement",
+        "arrondissement",
+        "date_debut",
+        "date_fin",
+        "search",
+        "bounds",
+        "near",
+    ],
 )
-def update_grid(type_evenement, emplacement, arrondissement, date_debut, date_fin):
-    df = pd.read_csv("evenements.csv")
-    if len(type_evenement) > 0:
-        df = df[df["type_evenement"].isin(type_evenement)]
-    if len(emplacement) > 0:
-        df = df[df["emplacement"].isin(emplacement)]
-    if len(arrondissement) > 0:
-        df = df[df["arrondissement"].isin(arrondissement)]
-    if date_debut:
-        df = df[df["date_debut"] >= date_debut]
-    if date_fin:
-        df = df[df["date_fin"] <= date_fin]
-    row_data = df.to_dict("records")
-    scatter_map = generate_map(df)
-    search_results = dcc.Markdown(
+
+
+def normalize_filters(
+    snapshot,
+    type_evenement,
+    emplacement,
+    arrondissement,
+    date_debut,
+    date_fin,
+    search,
+    map_filter=False,
+    bounds=None,
+    radius=None,
+    point=None,
+):
+    """Equivalent filter selections map to the same cache key.
+
+    The key carries the snapshot's mtime, so cached rows always match its frame.
+    """
+    return Filters(
+        snapshot.mtime,
+        tuple(sorted(type_evenement or [])),
+        tuple(sorted(emplacement or [])),
+        tuple(sorted(arrondissement or [])),
+        datetime.fromisoformat(date_debut).date().isoformat() if date_debut else None,
+        datetime.fromisoformat(date_fin).date().isoformat() if date_fin else None,
+        " ".join(tokenize(search or "")),
+        tuple(round(b, 4) for b in bounds) if map_filter and bounds else None,
+        (round(point[0], 4), round(point[1], 4), radius) if radius and point else None,
+    )
+
+
+def spatial_mask(snapshot, filters):
+    spatial = snapshot.spatial
+    mask = None
+    if filters.bounds:
+        mask = spatial.in_bounds(*filters.bounds)
+    if filters.near:
+        near = spatial.within(*filters.near)
+        mask = near if mask is None else mask & near
+    return mask
+
+
+def filter_mask(snapshot, filters):
+    return store.filter_mask(
+        {col: getattr(filters, col) for col in CATEGORY_COLUMNS},
+        filters.date_debut,
+        filters.date_fin,
+        filters.search,
+        spatial_mask(snapshot, filters),
+        snapshot=snapshot,
+    )
+
+
+# Each callback reads the store once and passes that snapshot down; it is left
+# out of the cache keys, where the filters' version already identifies it
+@cache.memoize(args_to_ignore=["snapshot"])
+def sorted_rows(snapshot, filters, sort_model):
+    return store.sorted_rows(
+        filter_mask(snapshot, filters), sort_model, filters.search, snapshot=snapshot
+    )
+
+
+@cache.memoize(args_to_ignore=["snapshot"])
+def map_data(snapshot, filters, zoom):
+    return map_traces(snapshot, filter_mask(snapshot, filters), zoom)
+
+
+@cache.memoize(args_to_ignore=["snapshot"])
+def search_results(snapshot, filters):
+    df = snapshot.df[filter_mask(snapshot, filters)]
+    return dcc.Markdown(
         f"""
-            **{len(row_data)} événements trouvés**
+            **{len(df)} événements trouvés**
             
             📅 {df["type_evenement"].nunique()} types d'événements
             
@@ -205,7 +398,178 @@ def update_grid(type_evenement, emplacement, arrondissement, date_debut, date_fi
             📊 Source: [Données de la Ville de Montréal](https://donnees.montreal.ca/dataset/evenements-publics)
         """
     )
-    return row_data, scatter_map, search_results
+
+
+@callback(
+    Output("type_evenement", "data"),
+    Output("emplacement", "data"),
+    Output("arrondissement", "data"),
+    *filter_inputs,
+    *spatial_inputs,
+)
+def update_dropdowns(*filters):
+    snapshot = store.current()
+    filters = normalize_filters(snapshot, *filters)
+    facets = store.facets(
+        {col: list(getattr(filters, col)) for col in CATEGORY_COLUMNS},
+        filters.date_debut,
+        filters.date_fin,
+        filters.search,
+        spatial_mask(snapshot, filters),
+        snapshot=snapshot,
+    )
+    return facets["type_evenement"], facets["emplacement"], facets["arrondissement"]
+
+
+# Keep the integer zoom level so panning does not trigger a server round trip
+clientside_callback(
+    """
+    function (relayoutData, zoom) {
+        if (!relayoutData || relayoutData["map.zoom"] === undefined) {
+            return dash_clientside.no_update;
+        }
+        const level = Math.floor(relayoutData["map.zoom"]);
+        return level === zoom ? dash_clientside.no_update : level;
+    }
+    """,
+    Output("map-zoom", "data"),
+    Input("map", "relayoutData"),
+    State("map-zoom", "data"),
+)
+
+
+# Only followed while the map filter is on, so panning otherwise stays in the
+# browser; switching it on reads the view left by the last pan or zoom
+clientside_callback(
+    """
+    function (relayoutData, checked) {
+        const derived = relayoutData && relayoutData["map._derived"];
+        if (!checked || !derived) {
+            return dash_clientside.no_update;
+        }
+        const lons = derived.coordinates.map((c) => c[0]);
+        const lats = derived.coordinates.map((c) => c[1]);
+        return [
+            Math.min(...lons), Math.min(...lats), Math.max(...lons), Math.max(...lats)
+        ];
+    }
+    """,
+    Output("map-bounds", "data"),
+    Input("map", "relayoutData"),
+    Input("map-filter", "checked"),
+)
+
+
+# Likewise only followed once a radius is set, from the last click on the map
+clientside_callback(
+    """
+    function (clickData, radius) {
+        const point = clickData && clickData.points[0];
+        return radius && point ? [point.lat, point.lon] : dash_clientside.no_update;
+    }
+    """,
+    Output("map-point", "data"),
+    Input("map", "clickData"),
+    Input("radius", "value"),
+)
+
+
+@callback(
+    Output("map", "figure"),
+    Output("map-version", "data"),
+    *filter_inputs,
+    Input("map-zoom", "data"),
+    State("map-version", "data"),
+)
+def update_map(*args):
+    *filters, zoom, version = args
+    snapshot = store.current()
+    traces, cluster_sizes = map_data(
+        snapshot, normalize_filters(snapshot, *filters), zoom
+    )
+    if version != snapshot.mtime:
+        # The event types may have changed, so the base traces are rebuilt
+        scatter_map = generate_map(snapshot)
+        for trace, data in zip(scatter_map.data, traces):
+            trace.update(data)
+        scatter_map.data[-1].marker.size = cluster_sizes
+        return scatter_map, snapshot.mtime
+    patched_map = Patch()
+    for i, data in enumerate(traces):
+        patched_map["data"][i].update(data)
+    patched_map["data"][len(traces) - 1]["marker"]["size"] = cluster_sizes
+    return patched_map, no_update
+
+
+@callback(
+    Output("search-results", "children"),
+    *filter_inputs,
+    *spatial_inputs,
+)
+def update_search_results(*filters):
+    snapshot = store.current()
+    return search_results(snapshot, normalize_filters(snapshot, *filters))
+
+
+# Drop the grid's cached blocks so it requests the new filter results
+clientside_callback(
+    """
+    function () {
+        dash_ag_grid.getApiAsync("grid").then((api) => api.purgeInfiniteCache());
+    }
+    """,
+    *filter_inputs,
+    *spatial_inputs,
+    prevent_initial_call=True,
+)
+
+
+@callback(
+    Output("grid", "getRowsResponse"),
+    Input("grid", "getRowsRequest"),
+    *[
+        State(i.component_id, i.component_property)
+        for i in filter_inputs + spatial_inputs
+    ],
+)
+def get_rows(request, *filters):
+    if not request:
+        return no_update
+    snapshot = store.current()
+    rows = sorted_rows(
+        snapshot, normalize_filters(snapshot, *filters), request.get("sortModel")
+    )
+    block = rows[request["startRow"] : request["endRow"]]
+    df = snapshot.df.iloc[block][grid_columns]
+    row_data = df.assign(
+        **{col: df[col].dt.strftime("%Y-%m-%d") for col in DATE_COLUMNS}
+    ).to_dict("records")
+    return {"rowData": row_data, "rowCount": len(rows)}
+
+
+@cache.memoize(args_to_ignore=["snapshot"])
+def event_details(snapshot, event_id, version):
+    event = store.event(event_id, snapshot=snapshot)
+    event_info = html.Div(
+        [
+            dcc.Markdown(
+                f"**Coût :** {event['cout']}\n\n**Inscription :** {event['inscription']}\n\n**Emplacement :** {event['emplacement']}"
+            ),
+            html.A(
+                "Voir l'événement",
+                href=event["url_fiche"],
+                className="event-btn",
+                target="_blank",
+            ),
+        ]
+    )
+    date_debut = event["date_debut"].strftime("%b %d, %Y")
+    date_fin = event["date_fin"].strftime("%b %d, %Y")
+    event_date = dcc.Markdown(
+        f"**Date de début :** {date_debut}\n\n**Date de fin :** {date_fin}"
+    )
+    event_description = dcc.Markdown(f"**{event['titre']}**\n\n{event['description']}")
+    return event_info, event_date, event_description
 
 
 @callback(
@@ -215,43 +579,10 @@ def update_grid(type_evenement, emplacement, arrondissement, date_debut, date_fi
     Input("grid", "selectedRows"),
 )
 def update_event_description(selected_rows):
-    df = pd.read_csv("evenements.csv")
-    if selected_rows:
-        cout = selected_rows[0]["cout"]
-        inscription = selected_rows[0]["inscription"]
-        emplacement = selected_rows[0]["emplacement"]
-        link = selected_rows[0]["url_fiche"]
-        event_info = html.Div(
-            [
-                dcc.Markdown(
-                    f"**Coût :** {cout}\n\n**Inscription :** {inscription}\n\n**Emplacement :** {emplacement}"
-                ),
-                html.A(
-                    "Voir l'événement",
-                    href=link,
-                    className="event-btn",
-                    target="_blank",
-                ),
-            ]
-        )
-        date_debut_raw = selected_rows[0]["date_debut"]
-        date_fin_raw = selected_rows[0]["date_fin"]
-        try:
-            date_debut = datetime.strptime(date_debut_raw, "%Y-%m-%d").strftime(
-                "%b %d, %Y"
-            )
-            date_fin = datetime.strptime(date_fin_raw, "%Y-%m-%d").strftime("%b %d, %Y")
-        except:
-            date_debut = date_debut_raw
-            date_fin = date_fin_raw
-        event_date = dcc.Markdown(
-            f"**Date de début :** {date_debut}\n\n**Date de fin :** {date_fin}"
-        )
-
-        titre = selected_rows[0]["titre"]
-        description = selected_rows[0]["description"]
-        event_description = dcc.Markdown(f"**{titre}**\n\n{description}")
-        return event_info, event_date, event_description
+    snapshot = store.current()
+    if selected_rows and selected_rows[0]["id"] in snapshot.positions:
+        # The snapshot mtime is part of the key so a reload invalidates the cache
+        return event_details(snapshot, selected_rows[0]["id"], snapshot.mtime)
     no_data = dcc.Markdown(
         "Selectionnez un événement dans la grille pour voir les détails"
     )
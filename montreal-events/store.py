@@ -0,0 +1,467 @@
+import bisect
+import hashlib
+import math
+import os
+import re
+import sys
+import threading
+import unicodedata
+from collections import Counter, defaultdict, namedtuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+CATEGORY_COLUMNS = ["type_evenement", "emplacement", "arrondissement"]
+DATE_COLUMNS = ["date_debut", "date_fin"]
+CLUSTER_MAX_ZOOM = 13
+CLUSTER_SIZE_PX = 60
+TOKEN_RE = re.compile(r"\w+")
+
+
+def read_events_csv(path):
+    df = pd.read_csv(
+        path,
+        dtype={col: "category" for col in CATEGORY_COLUMNS},
+        parse_dates=DATE_COLUMNS,
+        date_format="%Y-%m-%d",
+    )
+    # The numeric suffix of url_fiche is the city's id for the event
+    df["id"] = df["url_fiche"].str.extract(r"-(\d+)/?$", expand=False).astype(int)
+    return df
+
+
+def file_checksum(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def snapshot_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ".arrow"
+
+
+def build_snapshot(csv_path, checksum=None):
+    """Write the typed events as an uncompressed Arrow IPC file next to the CSV."""
+    checksum = checksum or file_checksum(csv_path)
+    table = pa.Table.from_pandas(read_events_csv(csv_path), preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, b"csv_sha256": checksum.encode()}
+    )
+    path = snapshot_path(csv_path)
+    # Written aside then renamed so other workers never map a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def open_snapshot(csv_path, checksum):
+    """Memory-map the snapshot, or return None if it is missing or out of date."""
+    try:
+        table = pa.ipc.open_file(pa.memory_map(snapshot_path(csv_path))).read_all()
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return None
+    if table.schema.metadata.get(b"csv_sha256") != checksum.encode():
+        return None
+    return table
+
+
+def fold(text):
+    """Lowercase text without accents, so "Évènement" matches "evenement"."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(fold(text))
+
+
+class SearchIndex:
+    """Inverted index of the folded words of each event's titre and description."""
+
+    TITLE_WEIGHT = 3
+    MIN_PREFIX = 2
+
+    def __init__(self, titles, descriptions):
+        postings = defaultdict(Counter)
+        for row, (title, description) in enumerate(zip(titles, descriptions)):
+            for token in tokenize(title):
+                postings[token][row] += self.TITLE_WEIGHT
+            for token in tokenize(description):
+                postings[token][row] += 1
+        self.size = len(titles)
+        self.vocabulary = sorted(postings)
+        self.postings = {
+            token: (
+                np.fromiter(rows.keys(), dtype=int, count=len(rows)),
+                np.fromiter(rows.values(), dtype=float, count=len(rows)),
+            )
+            for token, rows in postings.items()
+        }
+
+    def _terms(self, token, prefix):
+        if not prefix or len(token) < self.MIN_PREFIX:
+            return [token] if token in self.postings else []
+        start = bisect.bisect_left(self.vocabulary, token)
+        end = bisect.bisect_left(self.vocabulary, token + "\uffff", start)
+        return self.vocabulary[start:end]
+
+    def scores(self, query):
+        """Relevance of every row for query; rows missing a query word score 0.
+
+        The last word is matched as a prefix so results follow the user's typing.
+
+        >>> index = SearchIndex(
+        ...     ["Fête de la musique", "Fête des voisins", "Atelier de poterie"],
+        ...     ["", "Concert et musique", ""],
+        ... )
+        >>> (index.scores("fete musique") > 0).tolist()
+        [True, True, False]
+        >>> (index.scores("poterie concert") > 0).tolist()
+        [False, False, False]
+        >>> (index.scores("xyzzy musique") > 0).tolist()
+        [False, False, False]
+        """
+        tokens = tokenize(query)
+        scores = np.zeros(self.size)
+        for i, token in enumerate(tokens):
+            token_scores = np.zeros(self.size)
+            for term in self._terms(token, prefix=i == len(tokens) - 1):
+                rows, weights = self.postings[term]
+                token_scores[rows] += weights * math.log(1 + self.size / len(rows))
+            if i:
+                matched = (token_scores > 0) & (scores > 0)
+                scores = np.where(matched, scores + token_scores, 0)
+            else:
+                scores = token_scores
+        return scores
+
+
+class SpatialIndex:
+    """Uniform grid over the events' coordinates, projected to km around the city.
+
+    Rows are sorted by cell so each grid column of a query box is one slice.
+    """
+
+    CELL_KM = 0.5
+    KM_PER_DEGREE = 111.2
+
+    def __init__(self, lat, lon):
+        self.size = len(lat)
+        located = ~(np.isnan(lat) | np.isnan(lon))
+        self.lat0 = np.mean(lat[located]) if located.any() else 0
+        self.lon0 = np.mean(lon[located]) if located.any() else 0
+        self.x, self.y = self._project(lat, lon)
+        cx, cy = self._cell(self.x[located]), self._cell(self.y[located])
+        self.cx_range = (cx.min(), cx.max()) if located.any() else (0, -1)
+        self.cy_min = cy.min() if located.any() else 0
+        self.span = (cy.max() - self.cy_min + 1) if located.any() else 1
+        keys = cx * self.span + (cy - self.cy_min)
+        order = np.argsort(keys, kind="stable")
+        self.rows = np.flatnonzero(located)[order]
+        self.keys = keys[order]
+
+    def _project(self, lat, lon):
+        x = (lon - self.lon0) * self.KM_PER_DEGREE * np.cos(np.radians(self.lat0))
+        y = (lat - self.lat0) * self.KM_PER_DEGREE
+        return x, y
+
+    def _cell(self, km):
+        return np.floor(km / self.CELL_KM).astype(int)
+
+    def _candidates(self, x0, y0, x1, y1):
+        cy0 = max(self._cell(y0) - self.cy_min, 0)
+        cy1 = min(self._cell(y1) - self.cy_min, self.span - 1)
+        if cy0 > cy1:
+            return self.rows[:0]
+        cx0 = max(self._cell(x0), self.cx_range[0])
+        cx1 = min(self._cell(x1), self.cx_range[1])
+        columns = np.arange(cx0, cx1 + 1) * self.span
+        starts = np.searchsorted(self.keys, columns + cy0, side="left")
+        ends = np.searchsorted(self.keys, columns + cy1, side="right")
+        return np.concatenate(
+            [self.rows[start:end] for start, end in zip(starts, ends)] + [self.rows[:0]]
+        )
+
+    def _mask(self, rows):
+        mask = np.zeros(self.size, dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def in_bounds(self, west, south, east, north):
+        """Mask of the events inside a lon/lat box, e.g. the map viewport."""
+        (x0, x1), (y0, y1) = self._project(
+            np.array([south, north]), np.array([west, east])
+        )
+        rows = self._candidates(x0, y0, x1, y1)
+        x, y = self.x[rows], self.y[rows]
+        return self._mask(rows[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)])
+
+    def within(self, lat, lon, km):
+        """Mask of the events at most km kilometres from a point."""
+        x, y = self._project(np.array(lat), np.array(lon))
+        rows = self._candidates(x - km, y - km, x + km, y + km)
+        distance = np.hypot(self.x[rows] - x, self.y[rows] - y)
+        return self._mask(rows[distance <= km])
+
+
+# Everything derived from one load of the CSV. A reload builds a new one and
+# swaps it in with a single assignment, so a query that takes the snapshot
+# once never mixes the frame of one load with the indexes of another.
+Snapshot = namedtuple(
+    "Snapshot",
+    [
+        "mtime",
+        "df",
+        "bitmaps",
+        "date_index",
+        "orders",
+        "positions",
+        "cells",
+        "vocabularies",
+        "search",
+        "spatial",
+    ],
+)
+
+
+class EventStore:
+    """Events mapped from the Arrow snapshot, reloaded when the CSV file changes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    @property
+    def mtime(self):
+        return self.snapshot.mtime if self.snapshot else None
+
+    def refresh(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return
+        with self._lock:
+            if mtime != self.mtime:
+                df = self._load()
+                date_index = {col: self._sorted_index(df[col]) for col in DATE_COLUMNS}
+                self.snapshot = Snapshot(
+                    mtime=mtime,
+                    df=df,
+                    bitmaps={col: self._bitmaps(df[col]) for col in CATEGORY_COLUMNS},
+                    date_index=date_index,
+                    orders={col: order for col, (order, _) in date_index.items()},
+                    positions={event_id: i for i, event_id in enumerate(df["id"])},
+                    cells=self._cells(df),
+                    vocabularies={
+                        col: list(df[col].cat.categories) for col in CATEGORY_COLUMNS
+                    },
+                    search=SearchIndex(
+                        df["titre"].fillna("").to_numpy(),
+                        df["description"].fillna("").to_numpy(),
+                    ),
+                    spatial=SpatialIndex(df["lat"].to_numpy(), df["long"].to_numpy()),
+                )
+
+    def current(self):
+        """The snapshot of the latest load; queries read it once and use only it."""
+        self.refresh()
+        return self.snapshot
+
+    def _load(self):
+        checksum = file_checksum(self.path)
+        table = open_snapshot(self.path, checksum)
+        if table is None:
+            build_snapshot(self.path, checksum)
+            table = open_snapshot(self.path, checksum)
+        # Text columns stay as Arrow strings backed by the shared mapped pages
+        return table.to_pandas(
+            split_blocks=True,
+            types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get,
+        )
+
+    @staticmethod
+    def _bitmaps(column):
+        codes = column.cat.codes.to_numpy()
+        return {value: codes == i for i, value in enumerate(column.cat.categories)}
+
+    @staticmethod
+    def _sorted_index(column):
+        values = column.to_numpy()
+        order = np.argsort(values, kind="stable")
+        return order, values[order]
+
+    @staticmethod
+    def _cells(df):
+        """Map cell of every located event at each clustered zoom level."""
+        lat = df["lat"].to_numpy()
+        lon = df["long"].to_numpy()
+        located = ~(np.isnan(lat) | np.isnan(lon))
+        # Web Mercator stretches latitude by 1 / cos(lat) around the city
+        aspect = np.cos(np.radians(np.nanmean(lat))) if located.any() else 1
+        cells = {}
+        for zoom in range(CLUSTER_MAX_ZOOM):
+            size = 360 / 2**zoom * CLUSTER_SIZE_PX / 256
+            x = np.floor(lon[located] / size)
+            y = np.floor(lat[located] / (size * aspect))
+            ids = np.full(len(df), -1)
+            ids[located] = np.unique(np.stack([x, y]), axis=1, return_inverse=True)[1]
+            cells[zoom] = ids
+        return cells
+
+    @property
+    def vocabularies(self):
+        return self.current().vocabularies
+
+    def event(self, event_id, snapshot=None):
+        snapshot = snapshot or self.current()
+        return snapshot.df.iloc[snapshot.positions[event_id]]
+
+    @staticmethod
+    def _date_mask(snapshot, col, bound, side):
+        order, values = snapshot.date_index[col]
+        mask = np.zeros(len(order), dtype=bool)
+        cut = np.searchsorted(values, np.datetime64(bound), side=side)
+        if side == "left":
+            mask[order[cut:]] = True
+        else:
+            mask[order[:cut]] = True
+        return mask
+
+    @staticmethod
+    def _category_mask(snapshot, col, values):
+        bitmaps = snapshot.bitmaps[col]
+        mask = np.zeros(len(snapshot.df), dtype=bool)
+        for value in values:
+            if value in bitmaps:
+                mask |= bitmaps[value]
+        return mask
+
+    def _base_mask(self, snapshot, date_debut, date_fin, query, within):
+        mask = np.ones(len(snapshot.df), dtype=bool)
+        if within is not None:
+            mask &= within
+        if query:
+            mask &= snapshot.search.scores(query) > 0
+        if date_debut:
+            mask &= self._date_mask(
+                snapshot, "date_debut", pd.Timestamp(date_debut).normalize(), "left"
+            )
+        if date_fin:
+            mask &= self._date_mask(
+                snapshot, "date_fin", pd.Timestamp(date_fin).normalize(), "right"
+            )
+        return mask
+
+    def filter_mask(
+        self,
+        filters=None,
+        date_debut=None,
+        date_fin=None,
+        query=None,
+        within=None,
+        snapshot=None,
+    ):
+        """Row mask for the selected category values, date bounds and search query.
+
+        within is an optional mask, such as a SpatialIndex query, to intersect.
+        Pass the snapshot the caller already holds to keep positions consistent.
+        """
+        snapshot = snapshot or self.current()
+        mask = self._base_mask(snapshot, date_debut, date_fin, query, within)
+        for col, values in (filters or {}).items():
+            if values:
+                mask &= self._category_mask(snapshot, col, values)
+        return mask
+
+    def facets(
+        self,
+        filters,
+        date_debut=None,
+        date_fin=None,
+        query=None,
+        within=None,
+        snapshot=None,
+    ):
+        """Values of each filtered column still reachable under the other filters."""
+        snapshot = snapshot or self.current()
+        base = self._base_mask(snapshot, date_debut, date_fin, query, within)
+        masks = {
+            col: self._category_mask(snapshot, col, values)
+            for col, values in filters.items()
+            if values
+        }
+        facets = {}
+        for col in filters:
+            mask = base.copy()
+            for other, other_mask in masks.items():
+                if other != col:
+                    mask &= other_mask
+            codes = snapshot.df[col].cat.codes.to_numpy()[mask]
+            counts = np.bincount(
+                codes[codes >= 0], minlength=len(snapshot.vocabularies[col])
+            )
+            facets[col] = [
+                value
+                for value, count in zip(snapshot.vocabularies[col], counts)
+                if count or value in filters[col]
+            ]
+        return facets
+
+    def clusters(self, mask, zoom, snapshot=None):
+        """Centroid and event count of the map cells holding the rows in mask."""
+        snapshot = snapshot or self.current()
+        selected = mask & (snapshot.cells[zoom] >= 0)
+        ids = snapshot.cells[zoom][selected]
+        counts = np.bincount(ids)
+        lat = np.bincount(ids, weights=snapshot.df["lat"].to_numpy()[selected])
+        lon = np.bincount(ids, weights=snapshot.df["long"].to_numpy()[selected])
+        filled = counts > 0
+        counts = counts[filled]
+        return lat[filled] / counts, lon[filled] / counts, counts
+
+    @staticmethod
+    def _order(snapshot, col):
+        # Built lazily into the snapshot's own dict, so a reload drops them too
+        if col not in snapshot.orders:
+            snapshot.orders[col] = (
+                snapshot.df[col]
+                .sort_values(kind="stable", na_position="last")
+                .index.to_numpy()
+            )
+        return snapshot.orders[col]
+
+    def sorted_rows(self, mask, sort_model=None, query=None, snapshot=None):
+        """Positions of the rows in mask, ordered like an AG Grid sortModel.
+
+        Without a sortModel, rows matching a search query come by relevance.
+        """
+        snapshot = snapshot or self.current()
+        if not sort_model:
+            rows = np.flatnonzero(mask)
+            if query:
+                rows = rows[
+                    np.argsort(-snapshot.search.scores(query)[rows], kind="stable")
+                ]
+            return rows
+        if len(sort_model) == 1:
+            col = sort_model[0]["colId"]
+            order = self._order(snapshot, col)
+            rows = order[mask[order]]
+            if sort_model[0]["sort"] != "desc":
+                return rows
+            # Missing values stay last in both directions, as with sort_values
+            missing = snapshot.df[col].isna().to_numpy()[rows]
+            return np.concatenate([rows[~missing][::-1], rows[missing]])
+        subset = snapshot.df[mask].sort_values(
+            by=[s["colId"] for s in sort_model],
+            ascending=[s["sort"] == "asc" for s in sort_model],
+            kind="stable",
+        )
+        return subset.index.to_numpy()
+
+
+if __name__ == "__main__":
+    build_snapshot(sys.argv[1] if len(sys.argv) > 1 else "evenements.csv")
@@ -1,12 +1,48 @@
-from datetime import datetime
+import io
+import time
+
 import dash_ag_grid as dag
 import dash_mantine_components as dmc
+import numpy as np
 import pandas as pd
 import plotly.express as px
-from dash import Dash, Input, Output, callback, dcc, html
+import plotly.graph_objects as go
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dash import (
+    Dash,
+    Input,
+    Output,
+    Patch,
+    State,
+    callback,
+    clientside_callback,
+    dcc,
+    html,
+)
+from flask import Response, abort, jsonify, request
+from store import (
+    RESOLUTION_EDGES,
+    IncidentStore,
+    lttb,
+    percentiles,
+    read_stations,
+)
 
 app = Dash(__name__)
 server = app.server
+store = IncidentStore("incidents_metro.csv", feed_path="incidents_live.csv")
+store.follow_feed()
+stations = read_stations("stations.csv")
+
+LINE_COLORS = {1: "#00b04f", 2: "#ff8c00", 4: "#ffd700", 5: "#009ee0"}
+IDLE_STATION_COLOR = "#3a4556"
+# Roughly the chart's width in pixels: more points than that cannot be told apart
+TIMESERIES_POINTS = 1200
+STREAM_SECONDS = 25
+STREAM_RETRY_MS = 1000
+STATION_SIZE_MIN = 6
+STATION_SIZE_MAX = 30
 symptomes_list = [
     "Clientèle",
     "Matériel roulant",
@@ -15,10 +51,129 @@ symptomes_list = [
     "Feu, fumée, odeur, produit, etc…",
 ]
 
+
+def generate_network_map():
+    """Every station at its coordinates; callbacks only patch sizes and colours."""
+    fig = go.Figure(
+        go.Scattermap(
+            lat=stations["latitude"],
+            lon=stations["longitude"],
+            text=stations.index,
+            customdata=[0] * len(stations),
+            mode="markers",
+            marker=dict(size=STATION_SIZE_MIN, color=IDLE_STATION_COLOR),
+            hovertemplate="<b>%{text}</b><br>Incidents: %{customdata}<extra></extra>",
+            hoverlabel=dict(
+                bgcolor="rgba(13, 20, 33, 0.9)",
+                bordercolor="#00ffff",
+                font=dict(color="#ffffff", family="Rajdhani"),
+            ),
+        )
+    )
+    fig.update_layout(
+        map=dict(
+            style="carto-darkmatter",
+            center=dict(lat=stations["latitude"].mean(), lon=-73.61),
+            zoom=10.5,
+        ),
+        uirevision="map",
+        paper_bgcolor="rgba(0,0,0,0)",
+        margin=dict(l=0, r=0, t=0, b=0),
+    )
+    return fig
+
+
+def generate_bar_chart(x_label, y_label="Nombre d'incidents"):
+    """Styled, empty bar chart; callbacks only patch its trace data."""
+    fig = px.bar(
+        pd.DataFrame({x_label: [], y_label: []}),
+        x=x_label,
+        y=y_label,
+    )
+    fig.update_traces(
+        marker_color="#00b04f", marker_line_color="#00ffff", marker_line_width=1
+    )
+    style_chart(fig)
+    fig.update_traces(
+        marker=dict(line=dict(color="#00ffff", width=1), color="#00b04f", opacity=0.8),
+        hovertemplate="<b>%{x}</b><br>Incidents: %{y}<extra></extra>",
+        hoverlabel=dict(
+            bgcolor="rgba(13, 20, 33, 0.9)",
+            bordercolor="#00ffff",
+            font=dict(color="#ffffff", family="Rajdhani"),
+        ),
+    )
+    return fig
+
+
+def style_chart(fig):
+    """Dark metro theme shared by the charts."""
+    fig.update_layout(
+        template="plotly_dark",
+        paper_bgcolor="rgba(0,0,0,0)",
+        plot_bgcolor="rgba(13, 20, 33, 0.1)",
+        font=dict(family="Rajdhani, sans-serif", color="#ffffff", size=12),
+        title=dict(
+            font=dict(family="Orbitron, monospace", color="#ff8c00", size=16),
+            x=0.5,
+            xanchor="center",
+        ),
+        xaxis=dict(
+            title_font=dict(color="#00ffff", family="Orbitron, monospace"),
+            tickfont=dict(color="#ffffff", family="Rajdhani, sans-serif"),
+            gridcolor="rgba(0, 158, 224, 0.2)",
+            showgrid=True,
+        ),
+        yaxis=dict(
+            title_font=dict(color="#00ffff", family="Orbitron, monospace"),
+            tickfont=dict(color="#ffffff", family="Rajdhani, sans-serif"),
+            gridcolor="rgba(0, 158, 224, 0.2)",
+            showgrid=True,
+        ),
+        margin=dict(l=40, r=40, t=60, b=40),
+        height=None,
+    )
+    return fig
+
+
+def generate_distribution_chart():
+    """Resolution time histogram; bars start at their bin edge and span its width."""
+    fig = generate_bar_chart("Temps de résolution (min)")
+    fig.update_traces(
+        offset=0,
+        hovertemplate="<b>%{customdata} min</b><br>Incidents: %{y}<extra></extra>",
+    )
+    return fig
+
+
+def generate_timeseries_chart():
+    """Incidents over time; callbacks only patch the downsampled x and y."""
+    fig = go.Figure(
+        go.Scattergl(
+            x=[],
+            y=[],
+            mode="lines",
+            line=dict(color="#00ffff", width=1.5),
+            hovertemplate="<b>%{x}</b><br>Incidents: %{y}<extra></extra>",
+            hoverlabel=dict(
+                bgcolor="rgba(13, 20, 33, 0.9)",
+                bordercolor="#00ffff",
+                font=dict(color="#ffffff", family="Rajdhani"),
+            ),
+        )
+    )
+    style_chart(fig)
+    fig.update_layout(yaxis_title="Nombre d'incidents", uirevision="timeseries")
+    return fig
+
+
 app.layout = dmc.MantineProvider(
     html.Div(
         [
             dcc.Interval(id="clock-interval", interval=1000, n_intervals=0),
+            dcc.Interval(id="clock-sync-interval", interval=15 * 60 * 1000),
+            dcc.Store(id="clock-offset", data=0),
+            dcc.Store(id="incident-revision", data=store.version),
             html.Div(
                 [
                     html.Div(
@@ -95,6 +250,25 @@ app.layout = dmc.MantineProvider(
                                         inputClassName="checklist-input-style",
                                         labelClassName="checklist-label-style",
                                     ),
+                                    html.Label(
+                                        "Exporter:",
+                                        className="filter-label-with-margin",
+                                    ),
+                                    html.Div(
+                                        [
+                                            html.A(
+                                                "CSV",
+                                                id="export-csv",
+                                                className="export-link",
+                                            ),
+                                            html.A(
+                                                "PARQUET",
+                                                id="export-parquet",
+                                                className="export-link",
+                                            ),
+                                        ],
+                                        className="export-links",
+                                    ),
                                 ],
                                 className="card filters",
                             ),
@@ -124,20 +298,27 @@ app.layout = dmc.MantineProvider(
                                                 "📅 CE MOIS-CI",
                                                 className="data-card-header success",
                                             ),
-                                            html.H2("89", className="data-card-value"),
+                                            html.H2(
+                                                id="incidents-mois",
+                                                className="data-card-value",
+                                            ),
                                         ],
                                         className="card small-card data-card",
                                     ),
                                     html.Div(
                                         [
                                             html.H4(
-                                                "⏱️ RÉSOLUTION MOY.",
+                                                "⏱️ RÉSOLUTION MÉDIANE",
                                                 className="data-card-header danger",
                                             ),
                                             html.H2(
-                                                id="resolution-moyenne",
+                                                id="resolution-mediane",
                                                 className="data-card-value",
                                             ),
+                                            html.Div(
+                                                id="resolution-percentiles",
+                                                className="data-card-detail",
+                                            ),
                                         ],
                                         className="card small-card data-card",
                                     ),
@@ -149,7 +330,46 @@ app.layout = dmc.MantineProvider(
                                     html.Div(
                                         [
                                             html.H4("🗺️ CARTOGRAPHIE RÉSEAU MÉTRO"),
-                                            dcc.Graph(id="map"),
+                                            dcc.Graph(
+                                                id="map", figure=generate_network_map()
+                                            ),
+                                        ],
+                                        className="card medium-card",
+                                    ),
+                                    html.Div(
+                                        [
+                                            html.H4("📊 TEMPS DE RÉSOLUTION"),
+                                            dcc.Graph(
+                                                id="resolution-distribution",
+                                                figure=generate_distribution_chart(),
+                                            ),
+                                        ],
+                                        className="card medium-card",
+                                    ),
+                                ],
+                                className="row",
+                            ),
+                            html.Div(
+                                [
+                                    html.Div(
+                                        [
+                                            html.H4("📈 INCIDENTS DANS LE TEMPS"),
+                                            dmc.SegmentedControl(
+                                                id="timeseries-granularity",
+                                                data=[
+                                                    {"label": "Heure", "value": "hour"},
+                                                    {"label": "Jour", "value": "day"},
+                                                    {
+                                                        "label": "Semaine",
+                                                        "value": "week",
+                                                    },
+                                                ],
+                                                value="day",
+                                            ),
+                                            dcc.Graph(
+                                                id="timeseries",
+                                                figure=generate_timeseries_chart(),
+                                            ),
                                         ],
                                         className="card medium-card",
                                     ),
@@ -168,93 +388,278 @@ app.layout = dmc.MantineProvider(
 )
 
 
-@callback(Output("live-clock", "children"), Input("clock-interval", "n_intervals"))
-def update_clock(n_intervals):
-    return datetime.now().strftime("%H:%M:%S")
+@server.route(f"{app.config.routes_pathname_prefix}api/time")
+def server_time():
+    return jsonify(now=time.time() * 1000)
+
+
+# Rarely ask the server for its time to correct the browser clock's drift
+clientside_callback(
+    """
+    async function (n_intervals) {
+        const sent = Date.now();
+        const response = await fetch("%s", {cache: "no-store"});
+        const {now} = await response.json();
+        return now - (sent + Date.now()) / 2;
+    }
+    """
+    % app.get_relative_path("/api/time"),
+    Output("clock-offset", "data"),
+    Input("clock-sync-interval", "n_intervals"),
+)
+
+
+# The clock ticks in the browser, so the interval never reaches the server
+clientside_callback(
+    """
+    function (n_intervals, offset) {
+        const now = new Date(Date.now() + (offset || 0));
+        return [now.getHours(), now.getMinutes(), now.getSeconds()]
+            .map((n) => String(n).padStart(2, "0"))
+            .join(":");
+    }
+    """,
+    Output("live-clock", "children"),
+    Input("clock-interval", "n_intervals"),
+    State("clock-offset", "data"),
+)
+
+
+@server.route(f"{app.config.routes_pathname_prefix}api/incidents/stream")
+def incident_stream():
+    """Server-sent events with the store version each time incidents change.
+
+    Each response ends after STREAM_SECONDS, below gunicorn's worker timeout;
+    EventSource then reconnects with the last event id and resumes from it.
+    The id is the store version, which any worker can compare.
+    """
+    last_version = request.headers.get("Last-Event-ID")
+
+    def events():
+        revision = store.revision
+        version = store.version
+        deadline = time.monotonic() + STREAM_SECONDS
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        if last_version is not None and last_version != version:
+            yield f"id: {version}\ndata: {version}\n\n"
+        while (remaining := deadline - time.monotonic()) > 0:
+            latest = store.wait_for_change(revision, timeout=remaining)
+            if latest != revision:
+                revision = latest
+                version = store.version
+                yield f"id: {version}\ndata: {version}\n\n"
+
+    return Response(
+        events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file whose content is handed out as it is written."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def csv_export(chunks):
+    header = True
+    for chunk in chunks:
+        if header or not chunk.empty:
+            yield chunk.to_csv(index=False, header=header)
+            header = False
+
+
+def parquet_export(chunks):
+    sink = _ChunkSink()
+    writer = None
+    for chunk in chunks:
+        if writer is None:
+            # Columns of an empty first chunk have no inferred type: they are text
+            schema = pa.Schema.from_pandas(chunk.iloc[:0], preserve_index=False)
+            schema = pa.schema(
+                field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                for field in schema
+            )
+            writer = pq.ParquetWriter(sink, schema)
+        if not chunk.empty:
+            writer.write_table(
+                pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            )
+            yield sink.drain()
+    if writer is not None:
+        writer.close()
+    yield sink.drain()
+
+
+EXPORTS = {
+    "csv": (csv_export, "text/csv"),
+    "parquet": (parquet_export, "application/vnd.apache.parquet"),
+}
+
+
+@server.route(f"{app.config.routes_pathname_prefix}api/incidents/export.<fmt>")
+def export_incidents(fmt):
+    """Incidents selected by the dashboard filters, streamed as CSV or Parquet."""
+    if fmt not in EXPORTS:
+        abort(404)
+    year = request.args.get("year", type=int)
+    line = request.args.get("line", type=int)
+    symptoms = request.args.getlist("symptome")
+    export, mimetype = EXPORTS[fmt]
+    return Response(
+        export(store.export_chunks(year, line, symptoms)),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="incidents_{year}_ligne_{line}.{fmt}"'
+            )
+        },
+    )
+
+
+# The export links follow the filters, so a download matches what is on screen
+clientside_callback(
+    """
+    function (year, line, symptoms) {
+        const params = new URLSearchParams({year: year ?? "", line: line ?? ""});
+        (symptoms || []).forEach((symptom) => params.append("symptome", symptom));
+        return ["csv", "parquet"].map((fmt) => `%s.${fmt}?${params}`);
+    }
+    """
+    % app.get_relative_path("/api/incidents/export"),
+    Output("export-csv", "href"),
+    Output("export-parquet", "href"),
+    Input("year-dropdown", "value"),
+    Input("line-dropdown", "value"),
+    Input("incident-checklist", "value"),
+)
+
+
+# One stream per page; each message refreshes the callbacks using the version
+clientside_callback(
+    """
+    function (revision) {
+        if (!window.incidentStream) {
+            window.incidentStream = new EventSource("%s");
+            window.incidentStream.onmessage = (event) => {
+                dash_clientside.set_props(
+                    "incident-revision", {data: event.data}
+                );
+            };
+        }
+    }
+    """
+    % app.get_relative_path("/api/incidents/stream"),
+    Input("incident-revision", "data"),
+)
+
+
+@callback(Output("incidents-mois", "children"), Input("incident-revision", "data"))
+def update_month(revision):
+    return str(store.incidents_in_month(pd.Timestamp.now().to_period("M")))
 
 
 @callback(
     Output("map", "figure"),
     Output("total-incidents", "children"),
-    Output("resolution-moyenne", "children"),
     Input("year-dropdown", "value"),
     Input("line-dropdown", "value"),
     Input("incident-checklist", "value"),
+    Input("incident-revision", "data"),
 )
-def update_map(year, line, selected_incidents):
-    df = pd.read_csv("incidents_metro.csv")
-    df = df[df["Année civile"] == year]
-    df = df[df["Ligne"].astype(str).str.contains(str(line), na=False)]
-
-    if selected_incidents:
-        df = df[df["Symptome"].isin(selected_incidents)]
-    nombre_incidents = str(df["Numero d'incident"].nunique())
-    try:
-        df["Heure de l'incident"] = pd.to_datetime(
-            df["Heure de l'incident"], format="%H:%M", errors="coerce"
-        )
-        df["Heure de reprise"] = pd.to_datetime(
-            df["Heure de reprise"], format="%H:%M", errors="coerce"
-        )
-        df["resolution_time"] = (
-            df["Heure de reprise"] - df["Heure de l'incident"]
-        ).dt.total_seconds() / 60
-
-        mean_resolution = df["resolution_time"].mean()
-        if pd.notna(mean_resolution):
-            resolution_moyenne = f"{int(mean_resolution)} min"
-        else:
-            resolution_moyenne = "N/A"
-    except:
-        resolution_moyenne = "N/A"
-    grouped = df.groupby("Code de lieu").size().reset_index(name="Nombre d'incidents")
-    grouped = grouped.sort_values(by="Nombre d'incidents", ascending=False)
+def update_map(year, line, selected_incidents, revision):
+    cube = store.slice(year, line, selected_incidents)
+    nombre_incidents = str(cube["incidents"].sum())
+    # Stations missing from the coordinate table cannot be placed on the map
+    counts = cube["rows"].reindex(stations.index, fill_value=0).to_numpy()
+    highest = counts.max()
+    scale = np.sqrt(counts / highest) if highest else counts
+    on_line = stations["lines"].map(lambda lines: line in lines).to_numpy()
 
-    fig = px.bar(
-        grouped,
-        x="Code de lieu",
-        y="Nombre d'incidents",
-        labels={"Code de lieu": "Station", "Nombre d'incidents": "Nombre d'incidents"},
-    )
-    fig.update_traces(
-        marker_color="#00b04f", marker_line_color="#00ffff", marker_line_width=1
-    )
-    fig.update_layout(
-        template="plotly_dark",
-        paper_bgcolor="rgba(0,0,0,0)",
-        plot_bgcolor="rgba(13, 20, 33, 0.1)",
-        font=dict(family="Rajdhani, sans-serif", color="#ffffff", size=12),
-        title=dict(
-            font=dict(family="Orbitron, monospace", color="#ff8c00", size=16),
-            x=0.5,
-            xanchor="center",
-        ),
-        xaxis=dict(
-            title_font=dict(color="#00ffff", family="Orbitron, monospace"),
-            tickfont=dict(color="#ffffff", family="Rajdhani, sans-serif"),
-            gridcolor="rgba(0, 158, 224, 0.2)",
-            showgrid=True,
-        ),
-        yaxis=dict(
-            title_font=dict(color="#00ffff", family="Orbitron, monospace"),
-            tickfont=dict(color="#ffffff", family="Rajdhani, sans-serif"),
-            gridcolor="rgba(0, 158, 224, 0.2)",
-            showgrid=True,
-        ),
-        margin=dict(l=40, r=40, t=60, b=40),
-        height=None,
-    )
-    fig.update_traces(
-        marker=dict(line=dict(color="#00ffff", width=1), color="#00b04f", opacity=0.8),
-        hovertemplate="<b>%{x}</b><br>Incidents: %{y}<extra></extra>",
-        hoverlabel=dict(
-            bgcolor="rgba(13, 20, 33, 0.9)",
-            bordercolor="#00ffff",
-            font=dict(color="#ffffff", family="Rajdhani"),
-        ),
+    patched_fig = Patch()
+    patched_fig["data"][0]["customdata"] = counts.tolist()
+    patched_fig["data"][0]["marker"]["size"] = (
+        STATION_SIZE_MIN + (STATION_SIZE_MAX - STATION_SIZE_MIN) * scale
+    ).tolist()
+    patched_fig["data"][0]["marker"]["color"] = np.where(
+        on_line | (counts > 0),
+        LINE_COLORS.get(line, IDLE_STATION_COLOR),
+        IDLE_STATION_COLOR,
+    ).tolist()
+
+    return patched_fig, nombre_incidents
+
+
+@callback(
+    Output("resolution-mediane", "children"),
+    Output("resolution-percentiles", "children"),
+    Output("resolution-distribution", "figure"),
+    Input("year-dropdown", "value"),
+    Input("line-dropdown", "value"),
+    Input("incident-checklist", "value"),
+    Input("incident-revision", "data"),
+)
+def update_resolution(year, line, selected_incidents, revision):
+    counts = store.resolution_histogram(year, line, selected_incidents)
+    p50, p90, p99 = percentiles(counts, [0.5, 0.9, 0.99])
+
+    patched_fig = Patch()
+    if p50 is None:
+        patched_fig["data"][0]["x"] = []
+        patched_fig["data"][0]["y"] = []
+        return "N/A", "", patched_fig
+
+    # Bins past the 99th percentile are cut off so the tail does not flatten the bars
+    shown = int(np.searchsorted(RESOLUTION_EDGES, p99, side="right"))
+    edges = RESOLUTION_EDGES[: shown + 1]
+    patched_fig["data"][0]["x"] = edges[:-1].tolist()
+    patched_fig["data"][0]["y"] = counts[:shown].tolist()
+    patched_fig["data"][0]["width"] = np.diff(edges).tolist()
+    patched_fig["data"][0]["customdata"] = [
+        f"{start}–{end}" for start, end in zip(edges[:-1], edges[1:])
+    ]
+    return f"{p50:.0f} min", f"P90 {p90:.0f} min · P99 {p99:.0f} min", patched_fig
+
+
+@callback(
+    Output("timeseries", "figure"),
+    Input("timeseries-granularity", "value"),
+    Input("line-dropdown", "value"),
+    Input("incident-checklist", "value"),
+    Input("incident-revision", "data"),
+    Input("timeseries", "relayoutData"),
+)
+def update_timeseries(granularity, line, selected_incidents, revision, relayout):
+    # Zooming in re-queries only the visible range, down to single buckets
+    relayout = relayout or {}
+    start, end = relayout.get(
+        "xaxis.range",
+        [relayout.get("xaxis.range[0]"), relayout.get("xaxis.range[1]")],
     )
+    counts = store.timeline(granularity, line, selected_incidents, start, end)
+    counts = counts.iloc[lttb(counts.index.asi8, counts.to_numpy(), TIMESERIES_POINTS)]
 
-    return fig, nombre_incidents, resolution_moyenne
+    patched_fig = Patch()
+    patched_fig["data"][0]["x"] = counts.index.strftime("%Y-%m-%d %H:%M").tolist()
+    patched_fig["data"][0]["y"] = counts.astype(int).tolist()
+    return patched_fig
 
 
 if __name__ == "__main__":
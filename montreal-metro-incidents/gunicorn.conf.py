@@ -0,0 +1,9 @@
+# Each open page keeps an incident stream request running for up to 25 s,
+# holding one gthread thread meanwhile. Every worker gets a thread per wall
+# display, since nothing balances the streams across workers, plus spare
+# threads for the Dash callbacks, /api/time and exports.
+SCREENS = 100
+
+worker_class = "gthread"
+workers = 2
+threads = SCREENS + 16
@@ -0,0 +1,493 @@
+import io
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+LINES = {1: "verte", 2: "orange", 4: "jaune", 5: "bleue"}
+LINE_TOKEN_RE = re.compile(r"\d+(?:\.0+)?|[^\W\d_]+")
+# Aggregates are kept per cell of these dimensions, so a batch of new
+# incidents only rebuilds the cells it falls in
+CELL_DIMENSIONS = ["Année civile", "line", "Symptome"]
+# Histogram bin edges in minutes: one minute wide for the first hour, then
+# coarser; a resolution never spans more than a day once wrapped at midnight.
+RESOLUTION_EDGES = np.concatenate(
+    [np.arange(0, 60), np.arange(60, 240, 5), np.arange(240, 24 * 60 + 1, 30)]
+)
+# Time bucket granularities and the date_range frequency of their buckets
+TIMELINE_FREQUENCIES = {"hour": "h", "day": "D", "week": "W-MON"}
+EXPORT_CHUNK_ROWS = 50_000
+CSV_DTYPES = {"Ligne": str, "Symptome": "category", "Code de lieu": "category"}
+
+logger = logging.getLogger(__name__)
+
+
+# Everything built from one load of the files. Reloads and appends build a new
+# one and swap it in with a single assignment, so a reader that takes the
+# snapshot once never combines parts of two loads. seen_pairs and
+# seen_incidents are only read by the writer, to count each incident once.
+Snapshot = namedtuple(
+    "Snapshot",
+    [
+        "mtime",
+        "columns",
+        "frames",
+        "cube",
+        "histograms",
+        "timelines",
+        "monthly",
+        "seen_pairs",
+        "seen_incidents",
+    ],
+)
+
+
+def parse_lines(value):
+    """Metro line numbers named by a raw Ligne value.
+
+    Numbers must match a whole token, so "12" is not read as lines 1 and 2.
+
+    >>> parse_lines("2"), parse_lines("2.0"), parse_lines("Ligne verte")
+    ((2,), (2,), (1,))
+    >>> parse_lines("1, 2"), parse_lines("Orange / Bleue"), parse_lines("12")
+    ((1, 2), (2, 5), ())
+    >>> parse_lines(None), parse_lines(float("nan"))
+    ((), ())
+    """
+    if value is None or pd.isna(value):
+        return ()
+    numbers = {name: number for number, name in LINES.items()}
+    codes = set()
+    for token in LINE_TOKEN_RE.findall(str(value).lower()):
+        code = int(float(token)) if token[0].isdigit() else numbers.get(token)
+        if code in LINES:
+            codes.add(code)
+    return tuple(sorted(codes))
+
+
+def line_column(line):
+    return f"line_{line}"
+
+
+def read_stations(path):
+    """Station coordinates and the metro lines serving them, by Code de lieu."""
+    stations = pd.read_csv(path, index_col="Code de lieu", dtype={"Ligne": str})
+    stations["lines"] = stations["Ligne"].map(parse_lines)
+    return stations
+
+
+def lttb(x, y, threshold):
+    """Indices of the points kept by Largest-Triangle-Three-Buckets downsampling.
+
+    The first and last points are kept; every bucket in between keeps the
+    point forming the largest triangle with the previous pick and the mean
+    of the next bucket, which preserves peaks a plain stride would drop.
+
+    >>> x = np.arange(10)
+    >>> lttb(x, np.array([0, 0, 0, 9, 0, 0, 0, 0, 9, 0]), 4).tolist()
+    [0, 3, 8, 9]
+    >>> lttb(x, x, 20).tolist() == x.tolist()
+    True
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = [0]
+    for start, end, next_end in zip(edges, edges[1:], list(edges[2:]) + [n]):
+        previous = selected[-1]
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        selected.append(start + int(area.argmax()))
+    selected.append(n - 1)
+    return np.array(selected)
+
+
+def percentiles(counts, quantiles):
+    """Resolution minutes at the given quantiles of a RESOLUTION_EDGES histogram.
+
+    Values are interpolated linearly within the bin holding each quantile.
+
+    >>> counts = np.zeros(len(RESOLUTION_EDGES) - 1)
+    >>> counts[[2, 10]] = 50, 50
+    >>> [round(value, 2) for value in percentiles(counts, [0.5, 0.9, 0.99])]
+    [3.0, 10.8, 10.98]
+    >>> percentiles(counts * 0, [0.5])
+    [None]
+    """
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1] if len(cumulative) else 0
+    if not total:
+        return [None] * len(quantiles)
+    values = []
+    for quantile in quantiles:
+        target = quantile * total
+        i = min(int(np.searchsorted(cumulative, target)), len(counts) - 1)
+        within = (target - (cumulative[i] - counts[i])) / counts[i]
+        width = RESOLUTION_EDGES[i + 1] - RESOLUTION_EDGES[i]
+        values.append(float(RESOLUTION_EDGES[i] + within * width))
+    return values
+
+
+def _selected(cells, year, line, symptoms):
+    """Values of the (year, line, symptom) cells in a selection."""
+    return [
+        value
+        for (cell_year, cell_line, symptom), value in cells.items()
+        if cell_year == year
+        and cell_line == line
+        and (not symptoms or symptom in symptoms)
+    ]
+
+
+def _merge(cells, key, value):
+    """Add value to a cell, replacing it rather than updating it in place."""
+    if key in cells:
+        value = cells[key].add(value, fill_value=0).astype(int)
+    cells[key] = value
+
+
+class IncidentStore:
+    """Incidents loaded once in memory, reloaded when the CSV file changes.
+
+    Queries are answered from aggregates kept per year, line and symptom:
+    incident counts by station, resolution time histograms and incident
+    counts by time bucket.
+
+    New incidents appended to the feed file are added to the cells they fall
+    in as they arrive, without aggregating the history again.
+    """
+
+    def __init__(self, path, feed_path=None):
+        self.path = path
+        self.feed_path = feed_path
+        self.snapshot = None
+        self.revision = 0
+        self.feed_offset = 0
+        self.feed_inode = None
+        self.feed_header = None
+        self.changed = threading.Condition()
+        self._lock = threading.RLock()
+        self.refresh()
+
+    @property
+    def mtime(self):
+        return self.snapshot.mtime if self.snapshot else None
+
+    @property
+    def version(self):
+        """The loaded CSV mtime and feed offset, the same in every worker.
+
+        revision counts changes within this process only.
+        """
+        with self._lock:
+            return f"{self.mtime}-{self.feed_offset}"
+
+    def refresh(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return
+        with self._lock:
+            if mtime != self.mtime:
+                history = pd.read_csv(self.path, dtype=CSV_DTYPES)
+                empty = Snapshot(
+                    mtime=mtime,
+                    columns=list(history.columns),
+                    frames=(),
+                    cube={},
+                    histograms={},
+                    timelines={},
+                    monthly={},
+                    seen_pairs=set(),
+                    seen_incidents=set(),
+                )
+                snapshot = self._accumulate(empty, self._prepare(history))
+                # The feed is replayed on top of the reloaded history
+                self.feed_offset = 0
+                rows = self._read_feed()
+                if rows is not None:
+                    snapshot = self._accumulate(snapshot, rows)
+                self.snapshot = snapshot
+                self._notify()
+
+    @staticmethod
+    def _prepare(df):
+        df["Année civile"] = df["Année civile"].astype("Int16")
+        # Parsed once per distinct Ligne value, then one boolean column per line
+        lines = {value: parse_lines(value) for value in df["Ligne"].dropna().unique()}
+        for line in LINES:
+            values = [value for value, codes in lines.items() if line in codes]
+            df[line_column(line)] = df["Ligne"].isin(values)
+        incident = pd.to_datetime(
+            df["Heure de l'incident"], format="%H:%M", errors="coerce"
+        )
+        reprise = pd.to_datetime(
+            df["Heure de reprise"], format="%H:%M", errors="coerce"
+        )
+        minutes = (reprise - incident).dt.total_seconds() / 60
+        # Service resumed after midnight: the resumption is on the next day
+        df["resolution_minutes"] = minutes.mask(minutes < 0, minutes + 24 * 60)
+        if "Jour calendaire" in df:
+            df["date"] = pd.to_datetime(df["Jour calendaire"], errors="coerce")
+        else:
+            df["date"] = pd.NaT
+        df["timestamp"] = df["date"] + (incident - incident.dt.normalize())
+        return df
+
+    @staticmethod
+    def _explode(df):
+        """One row per incident and line; an incident on several lines is repeated."""
+        return pd.concat(
+            [df[df[line_column(line)]].assign(line=line) for line in LINES],
+            ignore_index=True,
+        )
+
+    @classmethod
+    def _accumulate(cls, snapshot, rows):
+        """A snapshot with prepared rows added to it.
+
+        Only the cells the rows fall in are rebuilt; the other cells and the
+        frames already loaded are shared with the previous snapshot. Within a
+        line, an incident number has a single year, symptom, station and time,
+        so counting its first row only gives distinct incidents per cell.
+        """
+        exploded = cls._explode(rows)
+        pairs = pd.Series(list(zip(exploded["Numero d'incident"], exploded["line"])))
+        unseen = np.array([pair not in snapshot.seen_pairs for pair in pairs], bool)
+        exploded["first"] = ~pairs.duplicated() & unseen
+        snapshot.seen_pairs.update(pairs)
+
+        return snapshot._replace(
+            frames=snapshot.frames + (rows,),
+            cube=cls._cube(snapshot.cube, exploded),
+            histograms=cls._histograms(snapshot.histograms, exploded),
+            timelines=cls._timelines(snapshot.timelines, exploded),
+            monthly=cls._monthly(snapshot.monthly, snapshot.seen_incidents, rows),
+        )
+
+    @staticmethod
+    def _cube(cube, exploded):
+        """Rows and distinct incidents by station, per year, line and symptom.
+
+        An incident on several lines is counted once under each of them.
+        """
+        cube = dict(cube)
+        counts = exploded.groupby(CELL_DIMENSIONS + ["Code de lieu"], observed=True)[
+            "first"
+        ].agg(rows="size", incidents="sum")
+        for key, stations in counts.groupby(level=CELL_DIMENSIONS, observed=True):
+            stations = stations.droplevel(CELL_DIMENSIONS)
+            stations.index = stations.index.astype(str)
+            _merge(cube, key, stations)
+        return cube
+
+    @staticmethod
+    def _histograms(histograms, exploded):
+        """Resolution time histograms per year, line and symptom.
+
+        Each holds one count per RESOLUTION_EDGES bin, so the histograms of
+        any selection are merged by summing them.
+        """
+        histograms = dict(histograms)
+        resolved = exploded.dropna(subset=["resolution_minutes"])
+        bins = len(RESOLUTION_EDGES) - 1
+        resolved = resolved.assign(
+            bin=(
+                np.searchsorted(
+                    RESOLUTION_EDGES, resolved["resolution_minutes"], side="right"
+                )
+                - 1
+            ).clip(0, bins - 1)
+        )
+        for key, cell in resolved.groupby(CELL_DIMENSIONS, observed=True)["bin"]:
+            histograms[key] = histograms.get(key, 0) + np.bincount(cell, minlength=bins)
+        return histograms
+
+    @staticmethod
+    def _timelines(timelines, exploded):
+        """Distinct incidents per time bucket, per granularity, line and symptom.
+
+        Each is a series holding the non-empty buckets only.
+        """
+        timelines = dict(timelines)
+        timed = exploded[exploded["first"] & exploded["timestamp"].notna()]
+        for granularity, frequency in TIMELINE_FREQUENCIES.items():
+            if granularity == "week":
+                buckets = timed["timestamp"].dt.to_period("W").dt.start_time
+            else:
+                buckets = timed["timestamp"].dt.floor(frequency)
+            counts = timed.groupby(["line", "Symptome", buckets], observed=True).size()
+            for (line, symptom), cell in counts.groupby(level=[0, 1], observed=True):
+                _merge(timelines, (granularity, line, symptom), cell.droplevel([0, 1]))
+        return timelines
+
+    @staticmethod
+    def _monthly(monthly, seen_incidents, rows):
+        """Distinct incidents per month, any line."""
+        monthly = dict(monthly)
+        incidents = rows["Numero d'incident"]
+        unseen = np.array(
+            [incident not in seen_incidents for incident in incidents], bool
+        )
+        first = ~incidents.duplicated() & unseen
+        seen_incidents.update(incidents)
+        new = rows[first]
+        for period, count in new.groupby(new["date"].dt.to_period("M")).size().items():
+            monthly[period] = monthly.get(period, 0) + count
+        return monthly
+
+    def _read_feed(self):
+        """The complete lines appended to the feed file since the last read."""
+        if not self.feed_path or not os.path.exists(self.feed_path):
+            return None
+        with open(self.feed_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            # A truncated or replaced feed file is read again from its start
+            if stat.st_ino != self.feed_inode or stat.st_size < self.feed_offset:
+                self.feed_inode = stat.st_ino
+                self.feed_offset = 0
+            if self.feed_offset == 0:
+                self.feed_header = f.readline()
+                self.feed_offset = f.tell()
+            f.seek(self.feed_offset)
+            chunk = f.read()
+        # A line still being written is picked up by the next read
+        chunk = chunk[: chunk.rfind(b"\n") + 1]
+        if not chunk:
+            return None
+        rows = self._parse_feed(chunk)
+        # Only moved past the chunk once its lines are parsed or skipped
+        self.feed_offset += len(chunk)
+        return rows
+
+    def _parse_feed(self, chunk):
+        """Prepared rows of a feed chunk, without the lines that fail to parse.
+
+        A malformed line is logged and skipped rather than retried, since it
+        would fail again on every poll and hold back the lines after it.
+        """
+        try:
+            return self._parse_lines(chunk)
+        except (TypeError, ValueError):
+            good = []
+            for line in chunk.splitlines(keepends=True):
+                try:
+                    self._parse_lines(line)
+                except (TypeError, ValueError):
+                    logger.warning("Skipped malformed feed line: %r", line)
+                else:
+                    good.append(line)
+            return self._parse_lines(b"".join(good)) if good else None
+
+    def _parse_lines(self, lines):
+        return self._prepare(
+            pd.read_csv(io.BytesIO(self.feed_header + lines), dtype=CSV_DTYPES)
+        )
+
+    def poll_feed(self):
+        """Add the complete lines appended to the feed file since the last poll."""
+        with self._lock:
+            rows = self._read_feed()
+            if rows is None:
+                return
+            self.snapshot = self._accumulate(self.snapshot, rows)
+        self._notify()
+
+    def _notify(self):
+        with self.changed:
+            self.revision += 1
+            self.changed.notify_all()
+
+    def wait_for_change(self, revision, timeout):
+        """Block until the revision moves past the given one, or timeout."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.revision != revision, timeout)
+            return self.revision
+
+    def follow_feed(self, interval=2):
+        """Poll the feed file from a daemon thread."""
+
+        def run():
+            while True:
+                try:
+                    self.poll_feed()
+                except Exception:
+                    # The thread must outlive a bad poll to ingest later rows
+                    logger.exception("Polling the feed file failed")
+                time.sleep(interval)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def current(self):
+        """The latest snapshot; take it once per query."""
+        self.refresh()
+        return self.snapshot
+
+    def slice(self, year, line, symptoms=None):
+        """Rows and distinct incidents by station for one year and line."""
+        cells = _selected(self.current().cube, year, line, symptoms)
+        if not cells:
+            return pd.DataFrame({"rows": [], "incidents": []}, dtype=int).rename_axis(
+                "Code de lieu"
+            )
+        return pd.concat(cells).groupby(level=0).sum().rename_axis("Code de lieu")
+
+    def export_chunks(self, year, line, symptoms=None, chunk_size=EXPORT_CHUNK_ROWS):
+        """Incidents matching the slice filters, as CSV columns, a chunk at a time.
+
+        Only one chunk of matching rows is copied at once; incidents appended
+        while exporting are left out.
+        """
+        snapshot = self.current()
+        for df in snapshot.frames:
+            for start in range(0, len(df), chunk_size):
+                chunk = df.iloc[start : start + chunk_size]
+                mask = (chunk["Année civile"] == year) & chunk.get(
+                    line_column(line), False
+                )
+                if symptoms:
+                    mask &= chunk["Symptome"].isin(symptoms)
+                yield chunk.loc[mask.fillna(False), snapshot.columns]
+
+    def resolution_histogram(self, year, line, symptoms=None):
+        """Merged resolution time histogram for one year and line."""
+        cells = _selected(self.current().histograms, year, line, symptoms)
+        return sum(cells, np.zeros(len(RESOLUTION_EDGES) - 1, dtype=int))
+
+    def timeline(self, granularity, line, symptoms=None, start=None, end=None):
+        """Incidents per time bucket for one line, empty buckets included."""
+        cells = [
+            cell
+            for (cell_granularity, cell_line, symptom), cell in (
+                self.current().timelines.items()
+            )
+            if cell_granularity == granularity
+            and cell_line == line
+            and (not symptoms or symptom in symptoms)
+        ]
+        if not cells:
+            return pd.Series(index=pd.DatetimeIndex([]), dtype=int)
+        counts = pd.concat(cells).groupby(level=0).sum().loc[start:end]
+        if counts.empty:
+            return counts
+        return counts.reindex(
+            pd.date_range(
+                counts.index[0],
+                counts.index[-1],
+                freq=TIMELINE_FREQUENCIES[granularity],
+            ),
+            fill_value=0,
+        )
+
+    def incidents_in_month(self, period):
+        return int(self.current().monthly.get(period, 0))
@@ -1,14 +1,16 @@
 import random
+from functools import lru_cache
 
 import dash
 import dash_mantine_components as dmc
 import humanize
 import numpy as np
-import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from dash import ALL, Input, Output, State, callback, ctx, dcc, html
+from dash import ALL, Input, Output, callback, ctx, dcc, html
 from dash_iconify import DashIconify
+from flask import jsonify
+from store import ATTRIBUTION_COLUMNS, MovieStore
 
 dash._dash_renderer._set_react_version("18.2.0")
 
@@ -17,7 +19,7 @@ app = dash.Dash(__name__)
 server = app.server
 
 # Load data once at startup
-df = pd.read_csv("data/data.csv")
+store = MovieStore("data/data.csv")
 
 
 def get_google_link(search):
@@ -165,24 +167,53 @@ def create_movie_card(movie, index, metric):
     )
 
 
-def create_graph(df, metric):
-    """Create stunning graph with streamlined code"""
-    df_aggregated = df.groupby(["year", "genre_1"]).agg({metric: "sum"}).reset_index()
+@lru_cache(maxsize=512)
+def movie_card(movie_id, metric, rank):
+    return create_movie_card(store.movie(movie_id), rank, metric)
 
+
+@lru_cache(maxsize=64)
+def movie_details_panel(genre, metric, attribution="primary"):
+    """Top movies card of a genre, built from the cached movie cards."""
+    movies = store.top_movies(genre, metric, columns=ATTRIBUTION_COLUMNS[attribution])
+    movie_cards = [
+        movie_card(movie_id, metric, rank)
+        for rank, movie_id in enumerate(movies["movie_id"])
+    ]
+    return dmc.Card(
+        [
+            dmc.Text(
+                f"Top {genre} Movies",
+                className="section-title",
+            ),
+            # Movie cards in enhanced scrollable container
+            html.Div(movie_cards, className="movie-cards-div"),
+        ],
+        p=10,
+        flex=2,
+        className="main-card",
+        h="calc(100vh - 100px)",
+    )
+
+
+@lru_cache(maxsize=None)
+def create_graph(metric, attribution="primary"):
+    """Create stunning graph with streamlined code, once per metric and attribution"""
     fig = go.Figure()
-    genres = sorted(df_aggregated["genre_1"].unique())
 
-    for i, genre in enumerate(genres):
-        genre_data = df_aggregated[df_aggregated["genre_1"] == genre]
+    for i, genre in enumerate(store.genres(attribution)):
+        genre_data = store.yearly_totals(metric, genre, attribution)
 
         fig.add_trace(
             go.Scatter(
-                x=genre_data["year"],
-                y=genre_data[metric],
+                x=genre_data.index,
+                y=genre_data,
                 name=genre,
                 mode="lines+markers",
                 line=dict(width=5, shape="spline", smoothing=1.3),
                 marker=dict(size=8),
+                # Read back on click: trace order differs between attributions
+                customdata=[genre] * len(genre_data),
                 hovertemplate=f"<b>{genre}</b><br>Year: %{{x}}<br>{metric.title()}: $%{{y:,.0f}}<extra></extra>",
             )
         )
@@ -229,12 +260,31 @@ app.layout = dmc.MantineProvider(
                         dmc.Group(
                             [
                                 dmc.Text("Metric Selection", size="lg", fw=700, mb=10),
-                                dmc.SegmentedControl(
-                                    id="segmented",
-                                    value="revenue",
-                                    data=[
-                                        {"value": i, "label": i.capitalize()}
-                                        for i in ["revenue", "budget"]
+                                dmc.Group(
+                                    [
+                                        dmc.SegmentedControl(
+                                            id="attribution",
+                                            value="primary",
+                                            data=[
+                                                {
+                                                    "value": "primary",
+                                                    "label": "Main genre",
+                                                },
+                                                {"value": "any", "label": "Any genre"},
+                                                {
+                                                    "value": "fractional",
+                                                    "label": "Split",
+                                                },
+                                            ],
+                                        ),
+                                        dmc.SegmentedControl(
+                                            id="segmented",
+                                            value="revenue",
+                                            data=[
+                                                {"value": i, "label": i.capitalize()}
+                                                for i in ["revenue", "budget"]
+                                            ],
+                                        ),
                                     ],
                                 ),
                             ],
@@ -278,6 +328,8 @@ app.layout = dmc.MantineProvider(
                     className="main-card",
                     h="calc(100vh - 100px)",
                 ),
+                # Replaced on each click; lays its card out as part of the row
+                html.Div(id="movie-details", style={"display": "contents"}),
             ],
             id="content",
             p=10,
@@ -293,59 +345,41 @@ app.layout = dmc.MantineProvider(
 @callback(
     Output("graph", "figure"),
     Input("segmented", "value"),
+    Input("attribution", "value"),
 )
-def update_graph(metric):
-    return create_graph(df, metric)
+def update_graph(metric, attribution):
+    return create_graph(metric, attribution)
 
 
 @callback(
-    Output("content", "children"),
+    Output("movie-details", "children"),
     Input("graph", "clickData"),
     Input("segmented", "value"),
-    State("content", "children"),
+    Input("attribution", "value"),
     prevent_initial_call=True,
 )
-def show_enhanced_movie_details(clickData, metric, content):
+def show_enhanced_movie_details(clickData, metric, attribution):
 
     if not clickData:
-        dash.no_update
+        return dash.no_update
 
-    genres = sorted(df["genre_1"].unique())
-    selected_genre = genres[clickData["points"][0]["curveNumber"]]
+    selected_genre = clickData["points"][0]["customdata"]
+    # The clicked genre may have no movies under the current attribution
+    if selected_genre not in store.genres(attribution):
+        return []
 
-    # Filter and sort movies
-    genre_movies = (
-        df[df["genre_1"] == selected_genre]
-        .dropna(subset=[metric])
-        .sort_values(by=metric, ascending=False)
-        .head(10)
-        .reset_index(drop=True)
-    )
+    return movie_details_panel(selected_genre, metric, attribution)
 
-    # Create stunning movie cards
-    movie_cards = [
-        create_movie_card(movie, i, metric)
-        for i, (_, movie) in enumerate(genre_movies.iterrows())
-    ]
 
-    details_content = content + [
-        dmc.Card(
-            [
-                dmc.Text(
-                    f"Top {selected_genre} Movies",
-                    className="section-title",
-                ),
-                # Movie cards in enhanced scrollable container
-                html.Div(movie_cards, className="movie-cards-div"),
-            ],
-            p=10,
-            flex=2,
-            className="main-card",
-            h="calc(100vh - 100px)",
-        )
-    ]
-
-    return details_content
+@server.route(f"{app.config.routes_pathname_prefix}api/cache-stats")
+def cache_stats():
+    """Hits, misses and sizes of the rendering caches, for monitoring."""
+    return jsonify(
+        {
+            cache.__name__: cache.cache_info()._asdict()
+            for cache in [create_graph, movie_details_panel, movie_card]
+        }
+    )
 
 
 if __name__ == "__main__":
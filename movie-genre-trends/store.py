@@ -0,0 +1,100 @@
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+METRICS = ["revenue", "budget", "domestic", "international"]
+GENRE_COLUMNS = ["genre_1", "genre_2", "genre_3", "genre_4"]
+# How a movie's totals are credited to genres: to its first genre only, in
+# full to each of its genres, or split evenly between them
+ATTRIBUTIONS = ["primary", "any", "fractional"]
+# Genre columns a movie is ranked under, by attribution
+ATTRIBUTION_COLUMNS = {
+    "primary": ("genre_1",),
+    "any": tuple(GENRE_COLUMNS),
+    "fractional": tuple(GENRE_COLUMNS),
+}
+
+
+class MovieStore:
+    """Movies loaded once, with the aggregates read by the callbacks precomputed."""
+
+    def __init__(self, path):
+        self.df = pd.read_csv(path)
+        self.positions = pd.Series(range(len(self.df)), index=self.df["movie_id"])
+        self._index_memberships()
+        self.yearly = {
+            attribution: self._yearly(attribution) for attribution in ATTRIBUTIONS
+        }
+        self.order = {}
+        self.rankings = {}
+        for metric in METRICS:
+            self._index_ranking(metric)
+
+    def _index_memberships(self):
+        """One entry per (movie, genre) pair, held as parallel arrays.
+
+        member_movies holds row positions, member_slots which genre column
+        (0 for genre_1) and member_genres codes into genre_names; the weight
+        of each entry is one over the number of genres of its movie.
+        """
+        genres = self.df[GENRE_COLUMNS].to_numpy()
+        present = pd.notna(genres)
+        self.member_movies, self.member_slots = np.nonzero(present)
+        self.genre_names, self.member_genres = np.unique(
+            genres[present].astype(str), return_inverse=True
+        )
+        self.member_weights = 1 / present.sum(axis=1)[self.member_movies]
+
+    def _yearly(self, attribution):
+        """Metric totals with one row per year and one column per (metric, genre)."""
+        members = self.member_slots == 0 if attribution == "primary" else slice(None)
+        movies = self.member_movies[members]
+        weights = self.member_weights[members] if attribution == "fractional" else 1
+        credited = pd.DataFrame(
+            {metric: self.df[metric].to_numpy()[movies] * weights for metric in METRICS}
+        )
+        credited["year"] = self.df["year"].to_numpy()[movies]
+        credited["genre"] = self.genre_names[self.member_genres[members]]
+        return credited.pivot_table(
+            index="year", columns="genre", values=METRICS, aggfunc="sum"
+        )
+
+    def _index_ranking(self, metric):
+        """Sort movies once by a metric and record each genre's ranks.
+
+        order[metric] lists row positions from the highest value down, and
+        rankings[metric][(column, genre)] the sorted ranks of the movies with
+        that genre in that column, so a top N is the first N ranks.
+        """
+        values = self.df[metric]
+        positions = np.flatnonzero(values.notna())
+        order = positions[np.argsort(-values.to_numpy()[positions], kind="stable")]
+        self.order[metric] = order
+        self.rankings[metric] = {}
+        for column in GENRE_COLUMNS:
+            genres = self.df[column].to_numpy()[order]
+            for genre, ranks in pd.Series(genres).groupby(genres).indices.items():
+                self.rankings[metric][(column, genre)] = ranks
+
+    def movie(self, movie_id):
+        return self.df.iloc[self.positions[movie_id]]
+
+    def genres(self, attribution="primary"):
+        """Genres credited with movies under an attribution, sorted."""
+        return list(self.yearly[attribution].columns.unique("genre"))
+
+    def yearly_totals(self, metric, genre, attribution="primary"):
+        """Yearly totals of a metric, over the years the genre has movies."""
+        return self.yearly[attribution][(metric, genre)].dropna()
+
+    def top_movies(self, genre, metric, n=10, columns=("genre_1",)):
+        """The n movies highest by metric with the genre in any of the columns."""
+        ranks = reduce(
+            np.union1d,
+            [
+                self.rankings[metric].get((column, genre), np.empty(0, dtype=int))
+                for column in columns
+            ],
+        )
+        return self.df.iloc[self.order[metric][ranks[:n]]].reset_index(drop=True)